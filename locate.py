@@ -1,11 +1,63 @@
-import json
 import math
+import os
+import queue
+import signal
+import threading
 import time
+import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from datetime import datetime
 
+try:
+    from numba import njit
+except ImportError:
+    # Without numba the location kernel runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+@njit(cache=True, fastmath=True)
+def _locate(esp32_pos, distances, room_mins, room_maxs, floor_height):
+    """Triangulate a position from ESP32 positions and distances and find its room index (-1 if outside)"""
+    # Weighted average of the ESP32 positions (closer ESP32s have more influence)
+    position = np.zeros(3)
+    total_weight = 0.0
+    for i in range(distances.shape[0]):
+        distance = distances[i]
+        weight = 1.0 / (distance * distance) if distance > 0.1 else 100.0
+        for axis in range(3):
+            position[axis] += esp32_pos[i, axis] * weight
+        total_weight += weight
+    position /= total_weight
+    
+    # Adjust for floor boundaries
+    if position[2] < floor_height * 0.5:
+        position[2] = 0.5 * floor_height  # Ground floor
+    elif position[2] < floor_height * 1.5:
+        position[2] = 1.5 * floor_height  # First floor
+    else:
+        position[2] = 2.5 * floor_height  # Second floor
+    
+    return position, _find_room(position, room_mins, room_maxs)
+
+
+@njit(cache=True, fastmath=True)
+def _find_room(position, room_mins, room_maxs):
+    """Find the index of the first room containing the position (-1 if outside)"""
+    for room in range(room_mins.shape[0]):
+        if (room_mins[room, 0] <= position[0] <= room_maxs[room, 0] and
+            room_mins[room, 1] <= position[1] <= room_maxs[room, 1] and
+            room_mins[room, 2] <= position[2] <= room_maxs[room, 2]):
+            return room
+    
+    return -1
+
+
 class DeviceLocationTracker:
-    def __init__(self, mqtt_broker="localhost", mqtt_port=1883):
+    def __init__(self, mqtt_broker="localhost", mqtt_port=1883, client_id="presense-tracker"):
         # Constants for conversion
         self.FEET_TO_METERS = 0.3048
         self.METERS_TO_FEET = 3.28084
@@ -36,6 +88,13 @@ class DeviceLocationTracker:
             "espresense_thetophat": [(self.home_length - 21) * self.FEET_TO_METERS, (self.home_width - 4) * self.FEET_TO_METERS,
                                    2 * self.floor_height + 10 * self.FEET_TO_METERS]
         }
+        self.esp32_positions = {esp32_id: tuple(pos) for esp32_id, pos in self.esp32_positions.items()}
+        
+        # ESP32 positions stacked into an Nx3 array, with each ESP32's row index keyed
+        # by its name in MQTT topics (without the "espresense_" prefix)
+        self._esp32_topic_index = {esp32_id.replace("espresense_", ""): i
+                                   for i, esp32_id in enumerate(self.esp32_positions)}
+        self._esp32_pos_arr = np.array(list(self.esp32_positions.values()), dtype=np.float64)
         
         # Define room boundaries
         self.define_room_boundaries()
@@ -49,33 +108,85 @@ class DeviceLocationTracker:
             # Add more devices as needed
         }
         
-        # Store latest readings from each ESP32 for each device
-        self.device_readings = {device_id: {} for device_id in self.device_names}
+        # Store latest readings from each ESP32 for each device as parallel arrays
+        # indexed like _esp32_pos_arr; missing readings have an infinite distance and age
+        self.device_readings = {
+            device_id: {"dist": np.full(len(self.esp32_positions), np.inf),
+                        "ts": np.full(len(self.esp32_positions), -np.inf)}
+            for device_id in self.device_names
+        }
+        
+        # Time of the last triangulation for each device
+        self._last_update = {}
+        
+        # Unconfirmed room change for each device as (room, first seen, times seen)
+        self._pending_room = {}
         
         # Store current location of each device
-        self.device_locations = {device_id: {"room": "Unknown", "position": [0, 0, 0], "timestamp": datetime.now().isoformat()}
+        started = datetime.now().isoformat()
+        self.device_locations = {device_id: {"room": "Unknown", "position": [0, 0, 0], "timestamp": started}
                                for device_id in self.device_names}
         
-        # MQTT setup
-        self.client = mqtt.Client()
+        # MQTT setup (MQTTv5 with a fixed client ID so the broker keeps our
+        # session and subscriptions across reconnects)
+        self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.max_inflight_messages_set(1000)
+        self.client.max_queued_messages_set(0)
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
+        self.session_expiry = 3600  # Seconds the broker keeps the session after a disconnect
         
-        # JSON file path
+        # JSON file paths: one file per device, plus an aggregate file of all
+        # devices that is rewritten at most every aggregate_interval seconds
         self.json_file = "device_locations.json"
+        self.device_dir = "device_locations"
+        self.aggregate_interval = 5.0
+        os.makedirs(self.device_dir, exist_ok=True)
+        
+        # Location changes are queued for a writer thread, which coalesces
+        # everything queued within flush_interval seconds into one write per device
+        self.flush_interval = 0.5
+        self._write_q = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._write_worker, daemon=True)
         
         # Signal attenuation factor due to floors/walls
         self.floor_attenuation = 1.5  # Additional meters of distance per floor difference
         self.wall_attenuation = 0.5   # Additional meters of distance per wall
         
+        # Readings older than reading_max_age seconds are not used for triangulation
+        self.reading_max_age = 60.0
+        
+        # Readings that change by less than distance_threshold meters within
+        # update_interval seconds of the last triangulation are not re-triangulated
+        self.update_interval = 2.0
+        self.distance_threshold = 0.5
+        
+        # A new room is only committed once it has been computed room_confirm_count
+        # times in a row or for room_confirm_time seconds, to avoid flapping near walls
+        self.room_confirm_count = 2
+        self.room_confirm_time = 2.0
+        
         # Load existing location data if available
         try:
-            with open(self.json_file, 'r') as f:
-                self.device_locations = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.update_json_file()
+            with open(self.json_file, 'rb') as f:
+                self.device_locations = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            pass
+            
+        # Device files are written before the aggregate file, so they take precedence
+        for device_id in self.device_names:
+            try:
+                with open(self._device_file(device_id), 'rb') as f:
+                    self.device_locations[device_id] = orjson.loads(f.read())
+            except (FileNotFoundError, orjson.JSONDecodeError):
+                pass
+                
+        # The aggregate file may be missing or behind the device files
+        self.update_json_file()
+        
+        self._writer_thread.start()
     
     def define_room_boundaries(self):
         # Define room boundaries as [x_min, x_max, y_min, y_max, z_min, z_max] in meters
@@ -102,156 +213,217 @@ class DeviceLocationTracker:
             "The Open Top": [0, self.home_length-20*self.FEET_TO_METERS, 0, self.home_width, 
                            2*self.floor_height, 3*self.floor_height]
         }
+        self.rooms = {room_name: tuple(bounds) for room_name, bounds in self.rooms.items()}
+        
+        # Room bounds stacked into (min, max) corner arrays for the room lookup kernel
+        self._room_names = list(self.rooms)
+        self._room_mins = np.array([[b[0], b[2], b[4]] for b in self.rooms.values()], dtype=np.float64)
+        self._room_maxs = np.array([[b[1], b[3], b[5]] for b in self.rooms.values()], dtype=np.float64)
     
     def connect_mqtt(self):
-        """Connect to the MQTT broker and start the loop"""
+        """Set up the MQTT broker connection; the network loop connects and reconnects"""
         print(f"Connecting to MQTT broker at {self.mqtt_broker}:{self.mqtt_port}...")
-        self.client.connect(self.mqtt_broker, self.mqtt_port, 60)
-        self.client.loop_start()
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry
+        self.client.connect_async(self.mqtt_broker, self.mqtt_port, 60, clean_start=False, properties=properties)
         
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback when connected to MQTT broker"""
         print(f"Connected to MQTT broker with result code {rc}")
         
-        # Subscribe to all ESP32 topics for tracked devices
-        for device_id in self.device_names:
-            for esp32_id in self.esp32_positions:
-                # Extract ESP32 name (without the "espresense_" prefix)
-                esp32_name = esp32_id.replace("espresense_", "")
-                topic = f"espresense/devices/{device_id}/{esp32_name}"
-                print(f"Subscribing to {topic}")
-                client.subscribe(topic)
+        # Subscribe to all device/ESP32 topics at once; on_message ignores
+        # devices and ESP32s that are not being tracked
+        topic = "espresense/devices/+/+"
+        print(f"Subscribing to {topic}")
+        client.subscribe(topic, qos=0)
     
     def on_message(self, client, userdata, msg):
         """Callback when message is received from MQTT broker"""
         try:
-            # Parse the message
-            payload = json.loads(msg.payload.decode('utf-8'))
-            
-            # Extract the device ID and ESP32 name from the topic
-            topic_parts = msg.topic.split('/')
+            # Extract the device ID and ESP32 row from the topic
+            topic_parts = msg.topic.split('/', 3)
             device_id = topic_parts[2]
-            esp32_name = "espresense_" + topic_parts[3]
+            i = self._esp32_topic_index.get(topic_parts[3])
             
-            # Check if this is a device we're tracking
-            if device_id not in self.device_names:
+            # Check if this is a device and ESP32 we're tracking
+            if device_id not in self.device_names or i is None:
                 return
                 
+            # Parse the message
+            payload = orjson.loads(msg.payload)
+            
             # Store the reading
-            if esp32_name in self.esp32_positions:
-                self.device_readings[device_id][esp32_name] = {
-                    "distance": payload.get("distance", 0),
-                    "timestamp": datetime.now().isoformat()
-                }
-                
-                # Triangulate position and update location
-                self.update_device_location(device_id)
+            readings = self.device_readings[device_id]
+            previous, previous_ts = readings["dist"][i], readings["ts"][i]
+            distance = readings["dist"][i] = payload.get("distance", 0)
+            now = readings["ts"][i] = time.monotonic()
+            
+            # Skip triangulation if the device was just located and this reading barely moved.
+            # The previous reading must still be fresh, otherwise it was left out of the last
+            # triangulation (a first reading is never fresh, as its placeholder age is infinite)
+            last_update = self._last_update.get(device_id)
+            if (last_update is not None and
+                now - last_update < self.update_interval and
+                now - previous_ts < self.reading_max_age and
+                abs(distance - previous) < self.distance_threshold):
+                return
+            
+            # Triangulate position and update location
+            self.update_device_location(device_id)
                 
         except Exception as e:
             print(f"Error processing message: {e}")
     
     def update_device_location(self, device_id):
         """Triangulate the device position and determine its room"""
-        readings = self.device_readings.get(device_id, {})
-        
-        # Need at least 3 readings for triangulation
-        if len(readings) < 3:
-            return
-            
-        # Filter out old readings (older than 60 seconds)
-        now = datetime.now()
-        valid_readings = {
-            esp32_id: reading for esp32_id, reading in readings.items()
-            if (now - datetime.fromisoformat(reading["timestamp"])).total_seconds() < 60
-        }
-        
-        if len(valid_readings) < 3:
+        # Need at least 3 valid readings for triangulation
+        valid = self._valid_mask(device_id)
+        if int(valid.sum()) < 3:
             return
             
-        # Triangulate position using multilateration
-        position = self.triangulate_position(device_id, valid_readings)
+        esp32_pos = self._esp32_pos_arr[valid]
+        distances = self.device_readings[device_id]["dist"][valid]
         
-        # Determine which room the device is in
-        room = self.determine_room(position)
+        # Triangulate position using multilateration and determine which room it is in
+        position, room_index = _locate(esp32_pos, distances, self._room_mins, self._room_maxs, self.floor_height)
+        room = self._room_name(room_index)
+        now = time.monotonic()
+        self._last_update[device_id] = now
         
         # Check if the room has changed
-        if room != self.device_locations[device_id].get("room", "Unknown"):
-            # Update device location
-            self.device_locations[device_id] = {
-                "room": room,
-                "position": position,
-                "timestamp": datetime.now().isoformat(),
-                "friendly_name": self.device_names.get(device_id, "Unknown Device")
-            }
-            
-            # Write to JSON file
-            self.update_json_file()
+        if room == self.device_locations[device_id].get("room", "Unknown"):
+            self._pending_room.pop(device_id, None)
+            return
             
-            print(f"{self.device_names.get(device_id, device_id)} moved to {room}")
-    
-    def triangulate_position(self, device_id, readings):
-        """Triangulate device position using weighted multilateration"""
-        # Weighted average calculation
-        total_weight = 0
-        position = [0, 0, 0]
+        # Wait until the new room is confirmed
+        pending = self._pending_room.get(device_id)
+        if pending is None or pending[0] != room:
+            pending = (room, now, 1)
+        else:
+            pending = (room, pending[1], pending[2] + 1)
+        if pending[2] < self.room_confirm_count and now - pending[1] < self.room_confirm_time:
+            self._pending_room[device_id] = pending
+            return
+        self._pending_room.pop(device_id, None)
         
-        for esp32_id, reading in readings.items():
-            esp32_pos = self.esp32_positions[esp32_id]
-            distance = reading["distance"]  # distance in meters
-            
-            # Calculate weight (closer ESP32s have more influence)
-            weight = 1 / (distance ** 2) if distance > 0.1 else 100
-            
-            # Add weighted position estimate
-            for i in range(3):
-                position[i] += esp32_pos[i] * weight
-                
-            total_weight += weight
+        # Update device location
+        record = self.device_locations[device_id] = {
+            "room": room,
+            "position": position.tolist(),
+            "timestamp": datetime.now().isoformat(),
+            "friendly_name": self.device_names.get(device_id, "Unknown Device")
+        }
         
-        # Normalize by total weight
-        if total_weight > 0:
-            position = [p / total_weight for p in position]
+        # Hand the changed record to the writer thread
+        self._write_q.put((device_id, record))
         
-        # Adjust for floor boundaries
-        if position[2] < self.floor_height * 0.5:
-            position[2] = 0.5 * self.floor_height  # Ground floor
-        elif position[2] < self.floor_height * 1.5:
-            position[2] = 1.5 * self.floor_height  # First floor
-        else:
-            position[2] = 2.5 * self.floor_height  # Second floor
-            
-        return position
+        print(f"{self.device_names.get(device_id, device_id)} moved to {room}")
+    
+    def _valid_mask(self, device_id):
+        """Return a mask of the device's readings that are finite and no older than reading_max_age"""
+        readings = self.device_readings[device_id]
+        return (readings["ts"] >= time.monotonic() - self.reading_max_age) & np.isfinite(readings["dist"])
     
     def determine_room(self, position):
         """Determine which room the position is in"""
-        for room_name, bounds in self.rooms.items():
-            if (bounds[0] <= position[0] <= bounds[1] and
-                bounds[2] <= position[1] <= bounds[3] and
-                bounds[4] <= position[2] <= bounds[5]):
-                return room_name
-                
-        return "Outside"
+        position = np.asarray(position, dtype=np.float64)
+        return self._room_name(_find_room(position, self._room_mins, self._room_maxs))
+    
+    def _room_name(self, room_index):
+        """Return the name of the room at room_index, or "Outside" for -1"""
+        return self._room_names[room_index] if room_index >= 0 else "Outside"
     
-    def update_json_file(self):
-        """Update the JSON file with current device locations"""
+    def update_json_file(self, snapshot=None):
+        """Update the aggregate JSON file with current device locations"""
+        if snapshot is None:
+            snapshot = dict(self.device_locations)
+        self._write_file(self.json_file, snapshot)
+    
+    def update_device_file(self, device_id, record):
+        """Update the JSON file of a single device"""
+        self._write_file(self._device_file(device_id), record)
+    
+    def _device_file(self, device_id):
+        """Return the JSON file path for a device"""
+        return os.path.join(self.device_dir, device_id.replace(":", "_") + ".json")
+    
+    def _write_file(self, path, data):
+        """Write data as JSON to a temporary file and swap it in so readers never see a partial file"""
+        tmp_file = path + ".tmp"
         try:
-            with open(self.json_file, 'w') as f:
-                json.dump(self.device_locations, f, indent=2)
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_file, path)
         except Exception as e:
             print(f"Error updating JSON file: {e}")
     
+    def _write_worker(self):
+        """Write queued location changes to the JSON files until a None is queued"""
+        aggregate = dict(self.device_locations)
+        aggregate_due = None  # When the aggregate file next needs rewriting
+        stopping = False
+        while not stopping:
+            # Wait for a change, or until the aggregate file is due
+            timeout = None if aggregate_due is None else max(0.0, aggregate_due - time.monotonic())
+            try:
+                item = self._write_q.get(timeout=timeout)
+            except queue.Empty:
+                self.update_json_file(aggregate)
+                aggregate_due = None
+                continue
+            if item is None:
+                break
+            
+            # Let a burst of updates queue up, then write each changed device once
+            time.sleep(self.flush_interval)
+            changed = dict([item])
+            while True:
+                try:
+                    item = self._write_q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    changed[item[0]] = item[1]
+                    
+            for device_id, record in changed.items():
+                self.update_device_file(device_id, record)
+            aggregate.update(changed)
+            
+            if aggregate_due is None:
+                aggregate_due = time.monotonic() + self.aggregate_interval
+            elif time.monotonic() >= aggregate_due:
+                self.update_json_file(aggregate)
+                aggregate_due = None
+                
+        # Bring the aggregate file up to date before exiting
+        if aggregate_due is not None:
+            self.update_json_file(aggregate)
+    
     def run(self):
         """Run the tracker"""
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
         try:
             self.connect_mqtt()
             print("Device location tracker running. Press Ctrl+C to exit.")
-            while True:
-                time.sleep(1)
+            self.client.loop_forever(retry_first_connection=True)
                 
         except KeyboardInterrupt:
             print("Stopping device location tracker...")
-            self.client.loop_stop()
             self.client.disconnect()
+            
+        finally:
+            # Let the writer thread flush any pending location changes, however the loop ended
+            self._write_q.put(None)
+            self._writer_thread.join()
+    
+    def _handle_sigterm(self, signum, frame):
+        """Stop the network loop on SIGTERM so run() can flush pending writes"""
+        print("Stopping device location tracker...")
+        # The handler interrupts the network loop on the main thread, which may hold
+        # paho's internal locks, so disconnect from a separate thread
+        threading.Thread(target=self.client.disconnect).start()
 
 if __name__ == "__main__":
     tracker = DeviceLocationTracker()